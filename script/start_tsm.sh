@@ -1 +1,2 @@
-transmission-remote -a $1 -w $2
\ No newline at end of file
+#!/bin/sh
+transmission-remote -a "$1" -w "$2"
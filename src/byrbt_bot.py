@@ -1,11 +1,16 @@
 import argparse
+import functools
+import json
 import logging
 import os
-import pickle
 import re
+import shutil
+import subprocess
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from urllib.request import urlopen
+from requests.adapters import HTTPAdapter
 
 import yaml
 from PIL import Image
@@ -13,6 +18,11 @@ from lxml import etree
 
 from decaptcha import DeCaptcha
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 _BASE_URL = 'https://bt.byr.cn/'
 _tag_map = {
     'free': '免费',
@@ -34,6 +44,22 @@ _cat_map = {
     '体育': 'sport',
     '记录': 'documentary',
 }
+_MAX_PAGE_SPAN = 10  # max pages a single `ls -p $from-$to` may fetch
+
+_RE_CAT = re.compile(r'-c (.+?) ', re.I)
+_RE_TAG = re.compile(r'-t (.+?) ', re.I)
+_RE_PAGE = re.compile(r'-p (\d+?) ', re.I)
+_RE_PAGE_RANGE = re.compile(r'-p (\d+)-(\d+) ', re.I)
+_RE_DL_ID = re.compile(r'dl (\d+)', re.I)
+_RE_LOC_L = re.compile(r' -l (.+)', re.I)
+_RE_LOC_C = re.compile(r' -c (.+)', re.I)
+_RE_TRM = re.compile(r'trm (\d+)', re.I)
+_RE_HREF_ID = re.compile(r'id=(\d+)&')
+
+_XP_FONTS = etree.XPath('./b/font/@class')
+_XP_SEEDING_IMG = etree.XPath('./img[@src="pic/seeding.png"]')
+_XP_FINISHED_IMG = etree.XPath('./img[@src="pic/finished.png"]')
+_XP_TEXT = etree.XPath('.//text()')
 
 
 def get_args():
@@ -43,6 +69,7 @@ def get_args():
     return parser.parse_args()
 
 
+@functools.lru_cache(maxsize=None)
 def parse_relative_path(path):
     if os.path.isabs(path):
         return path
@@ -55,10 +82,11 @@ def op_help():
     byrbt bot: a bot that handles basic usage of bt.byr.cn
     usage:
         1. list - list records based on constraints, 50 records per page
-            i.e. ls [-c $cat] [-t $tag] [-p $page]
+            i.e. ls [-c $cat] [-t $tag] [-p ($page)|($from-$to)]
                 $cat - category
                 $tag - free/2x upload, etc
                 $page - default 0
+                $from-$to - inclusive page range of at most {max_page_span} pages, pages are fetched concurrently
         
         2. search - search and list records based on constraints, 50 records per page
             i.e. se [-c $cat] [-t $tag] [-p $page] [-i $query]
@@ -83,7 +111,7 @@ def op_help():
         7. help - print this message
         8. exit
             
-    """
+    """.format(max_page_span=_MAX_PAGE_SPAN)
 
 
 class ByrbtBot(object):
@@ -96,32 +124,57 @@ class ByrbtBot(object):
         self._logger = logging.getLogger(__name__)
 
         self._session = requests.session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._executor = None
         self._session.headers = {
-            'User-Agent': 'Magic Browser'
+            'User-Agent': 'Magic Browser',
+            'Connection': 'keep-alive',
+            'Accept-Encoding': 'gzip, deflate',
         }
 
-        self._decaptcha = DeCaptcha()
-        self._decaptcha.load_model(parse_relative_path(config['bot_config']['model_location']))
+        # lxml parsers must not be shared across threads, keep one per fetching thread
+        self._parser_local = threading.local()
+
+        # the captcha model is only needed on login, load it on demand
+        self._model_loc = parse_relative_path(config['bot_config']['model_location'])
+        self._decaptcha = None
 
         cookie_loc = parse_relative_path(config['bot_config']['cookie_location'])
         if not os.path.exists(cookie_loc):
             os.makedirs(cookie_loc)
         self._cookie_loc = os.path.join(cookie_loc, 'cookie')
+        self._cookies_loaded = False
 
         self._seed_path = parse_relative_path(config['bot_config']['torrent']['save_location'])
         if not os.path.exists(self._seed_path):
             os.makedirs(self._seed_path)
 
+        self._start_tsm = parse_relative_path('script/start_tsm.sh')
         self._delete_after_activation = config['bot_config']['torrent']['delete_after_activation']
 
         self.config = config
 
+        self._ops = {
+            'ls': self.list,
+            'se': self.search,
+            'dl': self.download_torrent,
+            'tls': lambda op_str: self.list_torrent(),
+            'trm': self.remove_torrent,
+            'help': lambda op_str: print(op_help()),
+            'refresh': lambda op_str: self._refresh(),
+        }
+
     def _login(self):
         self._logger.info('start login process')
 
         login_page = self._get_url('login.php')
         image_url = login_page.xpath('//img[@alt="CAPTCHA"]/@src')[0]
-        image_file = Image.open(BytesIO(urlopen(_BASE_URL + image_url).read()))
+        image_file = Image.open(BytesIO(self._session.get(_BASE_URL + image_url).content))
+        if self._decaptcha is None:
+            self._decaptcha = DeCaptcha()
+            self._decaptcha.load_model(self._model_loc)
         captcha_text = self._decaptcha.decode(image_file)
         self._logger.debug('captcha text: {}'.format(captcha_text))
 
@@ -139,57 +192,78 @@ class ByrbtBot(object):
 
     def _save_cookies(self):
         self._logger.info('save cookies')
-        with open(self._cookie_loc, 'wb') as f:
-            pickle.dump(self._session.cookies, f)
+        cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'expires': c.expires,
+                    'secure': c.secure} for c in self._session.cookies]
+        with open(self._cookie_loc, 'w') as f:
+            json.dump(cookies, f)
 
     def _load_cookies(self):
         if os.path.exists(self._cookie_loc):
-            with open(self._cookie_loc, 'rb') as f:
+            with open(self._cookie_loc) as f:
                 self._logger.info('load cookie from file {}'.format(self.config['bot_config']['cookie_location']))
-                self._session.cookies = pickle.load(f)
-        else:
-            self._logger.info('load cookies by login')
-            self._login()
-            self._save_cookies()
+                try:
+                    jar = requests.cookies.RequestsCookieJar()
+                    for c in json.load(f):
+                        jar.set(c['name'], c['value'], domain=c['domain'], path=c['path'], expires=c['expires'],
+                                secure=c['secure'])
+                except (ValueError, AttributeError, KeyError, TypeError):
+                    jar = None
+            if jar is not None:
+                self._session.cookies = jar
+                return
+            self._logger.warning('invalid cookie file, possibly in a legacy format')
+        self._logger.info('load cookies by login')
+        self._login()
+        self._save_cookies()
+
+    def _ensure_session(self):
+        if self._cookies_loaded:
+            return
+        # mark first, `_login` fetches pages through `_get_url` as well
+        self._cookies_loaded = True
+        self._load_cookies()
+
+    def _get_html_parser(self):
+        parser = getattr(self._parser_local, 'parser', None)
+        if parser is None:
+            parser = etree.HTMLParser(encoding='utf-8', remove_comments=True, collect_ids=False)
+            self._parser_local.parser = parser
+        return parser
 
     def _get_url(self, url):
         self._logger.debug('get url: ' + url)
+        self._ensure_session()
         req = self._session.get(_BASE_URL + url)
-        return etree.HTML(req.text, etree.HTMLParser())
+        return etree.fromstring(req.content, self._get_html_parser())
+
+    def _refresh(self):
+        self._logger.info('refresh cookies by login')
+        self._cookies_loaded = True
+        self._login()
+        self._save_cookies()
 
     def start(self):
-        self._load_cookies()
         print(op_help())
         while True:
             action_str = input()
-            if action_str == 'refresh':
-                self._logger.info('refresh cookies by login')
-                self._login()
-                self._save_cookies()
-            elif action_str == 'exit':
+            cmd, _, _ = action_str.partition(' ')
+            if cmd == 'exit':
+                if self._executor is not None:
+                    self._executor.shutdown()
                 break
-            elif action_str == 'help':
-                print(op_help())
-            elif action_str.startswith('ls'):
-                self.list(action_str)
-            elif action_str.startswith('se'):
-                self.search(action_str)
-            elif action_str.startswith('dl'):
-                self.download_torrent(action_str)
-            elif action_str.startswith('tls'):
-                self.list_torrent()
-            elif action_str.startswith('trm'):
-                self.remove_torrent(action_str)
-            else:
+            op = self._ops.get(cmd)
+            if op is None:
                 print('invalid operation')
                 print(op_help())
+            else:
+                op(action_str)
 
-    def _get_list_url(self, op_str):
+    def _get_list_url(self, op_str, page_num=None):
         op_str += ' '
         self._logger.debug('list op: {}'.format(op_str))
 
         cat_str = ''
-        cat = re.findall(r'-c (.+?) ', op_str, re.I)
+        cat = _RE_CAT.findall(op_str)
         if len(cat) != 0:
             if self.config['bt_config']['category'][cat[0]] is None:
                 self._logger.info('no such category {}, use `all`'.format(cat[0]))
@@ -197,7 +271,7 @@ class ByrbtBot(object):
                 cat_str = str(self.config['bt_config']['category'][cat[0]]['all'])
 
         tag_str = ''
-        tag = re.findall(r'-t (.+?) ', op_str, re.I)
+        tag = _RE_TAG.findall(op_str)
         if len(tag) != 0:
             if self.config['bt_config']['tag'][tag[0]] is None:
                 self._logger.info('no such tag {}, use `all`'.format(tag[0]))
@@ -205,11 +279,14 @@ class ByrbtBot(object):
                 tag_str = str(self.config['bt_config']['tag'][tag[0]])
 
         page_num_str = '0'
-        page_num = re.findall(r'-p (\d+?) ', op_str, re.I)
-        if len(page_num) == 0:
-            self._logger.info('invalid page param, use `0`')
+        if page_num is None:
+            page_num = _RE_PAGE.findall(op_str)
+            if len(page_num) == 0:
+                self._logger.info('invalid page param, use `0`')
+            else:
+                page_num_str = str(page_num[0])
         else:
-            page_num_str = str(page_num[0])
+            page_num_str = str(page_num)
 
         url = 'torrents.php?'
         if cat_str != '':
@@ -228,24 +305,23 @@ class ByrbtBot(object):
         except KeyError:
             return ''
 
-    def _pretty_print_page(self, url):
-        page = self._get_url(url)
-        content_list = page.xpath('//table[@class="torrents"]/form/tr')
-        for i in range(1, len(content_list)):
-            item = content_list[i]
-            tds = item.xpath('./td')
-
-            cat = tds[0].xpath('./a/img/@title')[0]
-
-            main_td = tds[1].xpath('./table/tr/td')[0]
-            href = main_td.xpath('./a/@href')[0]
-            seed_id = re.findall(r'id=(\d+)&', href)[0]
-            title = main_td.xpath('./a/b/text()')[0]
-            sub = main_td.xpath('./br')
-            sub_title = sub[0].tail if len(sub) > 0 else ''
-            tags = set(main_td.xpath('./b/font/@class'))
-            is_seeding = len(main_td.xpath('./img[@src="pic/seeding.png"]')) > 0
-            is_finished = len(main_td.xpath('./img[@src="pic/finished.png"]')) > 0
+    def _pretty_print_page(self, page):
+        rows = page.iterfind('.//table[@class="torrents"]/form/tr')
+        next(rows, None)  # skip the table header
+        for i, item in enumerate(rows, 1):
+            tds = item.findall('td')
+
+            cat = tds[0].find('a/img').get('title')
+
+            main_td = tds[1].find('table/tr/td')
+            href = main_td.find('a').get('href')
+            seed_id = _RE_HREF_ID.findall(href)[0]
+            title = main_td.find('a/b').text or ''
+            sub = main_td.find('br')
+            sub_title = (sub.tail or '') if sub is not None else ''
+            tags = set(_XP_FONTS(main_td))
+            is_seeding = len(_XP_SEEDING_IMG(main_td)) > 0
+            is_finished = len(_XP_FINISHED_IMG(main_td)) > 0
             is_hot = False
             if 'hot' in tags:
                 is_hot = True
@@ -254,38 +330,65 @@ class ByrbtBot(object):
             if len(tags) > 0:
                 tag = self._get_tag(tags.pop())
 
-            file_size = "{} {}".format(tds[4].xpath('./text()')[0], tds[4].xpath('./br')[0].tail)
+            file_size = "{} {}".format(tds[4].text or '', tds[4].find('br').tail or '')
 
-            seeding = tds[5].xpath('.//text()')[0]
+            seeding = _XP_TEXT(tds[5])[0]
 
-            downloading = tds[6].xpath('.//text()')[0]
+            downloading = _XP_TEXT(tds[6])[0]
 
-            finished = tds[7].xpath('.//text()')[0]
+            finished = _XP_TEXT(tds[7])[0]
 
-            pretty_str = '{}.【\033[1;34m{}\033[0m】'.format(i, cat)
+            parts = ['{}.【\033[1;34m{}\033[0m】'.format(i, cat)]
             if is_hot:
-                pretty_str += '【\033[1;31m热门\033[0m】'
+                parts.append('【\033[1;31m热门\033[0m】')
             if tag != '':
-                pretty_str += '【\033[1;33m{}\033[0m】'.format(tag)
+                parts.append('【\033[1;33m{}\033[0m】'.format(tag))
             if is_seeding:
-                pretty_str += '【\033[1;36m做种中\033[0m】'
+                parts.append('【\033[1;36m做种中\033[0m】')
             if is_finished:
-                pretty_str += '【\033[1;36m已完成\033[0m】'
-            pretty_str += '\tid: {}\n\t{}'.format(seed_id, title)
+                parts.append('【\033[1;36m已完成\033[0m】')
+            parts.append('\tid: {}\n\t{}'.format(seed_id, title))
             if sub_title != '':
-                pretty_str += '\n\t\t{}'.format(sub_title)
-            pretty_str += '\n\t\t{}/{}/{}\t{}\n'.format(seeding, downloading, finished, file_size)
+                parts.append('\n\t\t{}'.format(sub_title))
+            parts.append('\n\t\t{}/{}/{}\t{}\n'.format(seeding, downloading, finished, file_size))
 
-            print(pretty_str)
+            print(''.join(parts))
 
     def list(self, op_str):
         """
-        full str: ls [-c $cat] [-t $tag] [-p $page]
+        full str: ls [-c $cat] [-t $tag] [-p ($page)|($from-$to)]
         :param op_str: `list` operation string
         :return: nothing, merely print the result based on constraints
         """
+        page_range = _RE_PAGE_RANGE.findall(op_str + ' ')
+        if len(page_range) != 0:
+            page_from, page_to = int(page_range[0][0]), int(page_range[0][1])
+            if page_from > page_to:
+                print('invalid page range: {}-{}'.format(page_from, page_to))
+                return
+            self.list_many(op_str, range(page_from, page_to + 1))
+            return
         url = self._get_list_url(op_str)
-        self._pretty_print_page(url)
+        self._pretty_print_page(self._get_url(url))
+
+    def list_many(self, op_str, pages):
+        """
+        fetch several pages concurrently, then print them in order
+        :param op_str: `list` operation string, its page param is ignored
+        :param pages: page numbers to list
+        :return: nothing, merely print the result based on constraints
+        """
+        pages = list(pages)
+        if len(pages) > _MAX_PAGE_SPAN:
+            print('too many pages: {}, list at most {} pages at once'.format(len(pages), _MAX_PAGE_SPAN))
+            return
+        urls = [self._get_list_url(op_str, page_num) for page_num in pages]
+        self._ensure_session()  # load cookies once before fanning out to the workers
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=8)
+        for page_num, page in zip(pages, self._executor.map(self._get_url, urls)):
+            print('\033[1;32m========== page {} ==========\033[0m'.format(page_num))
+            self._pretty_print_page(page)
 
     @staticmethod
     def _get_search_query(op_str):
@@ -305,7 +408,7 @@ class ByrbtBot(object):
         query = self._get_search_query(op_str)
         if query != '':
             url += '&{}'.format(query)
-        self._pretty_print_page(url)
+        self._pretty_print_page(self._get_url(url))
 
     @staticmethod
     def _get_cat(cat):
@@ -322,7 +425,7 @@ class ByrbtBot(object):
         :param op_str: `download` operation string
         :return: nothing, the result is printed
         """
-        id_re = re.findall(r'dl (\d+)', op_str, re.I)
+        id_re = _RE_DL_ID.findall(op_str)
         if len(id_re) == 0:
             print('no such torrent')
             return
@@ -338,13 +441,15 @@ class ByrbtBot(object):
 
         loc_str = ''
         if '-l' in op_str:
-            loc = re.findall(r' -l (.+)', op_str, re.I)
+            loc = _RE_LOC_L.findall(op_str)
             try:
                 loc_str = self.config['external_config']['torrent_location'][loc[0]]
             except KeyError:
                 print('no such predefined location: {}'.format(loc[0]))
         elif '-c' in op_str:
-            loc_str = re.findall(r' -c (.+)', op_str, re.I)
+            loc = _RE_LOC_C.findall(op_str)
+            if len(loc) != 0:
+                loc_str = loc[0]
         if loc_str == '':
             loc_str = self.config['external_config']['torrent_location'][cat]
         loc_str = os.path.abspath(os.path.expanduser(loc_str))
@@ -356,30 +461,40 @@ class ByrbtBot(object):
             os.makedirs(loc_str)
         seed_file_path = os.path.join(self._seed_path, file_name)
 
-        r = self._session.get(dl_url)
-        with open(seed_file_path, "wb") as f:
-            f.write(r.content)
+        with self._session.get(dl_url, stream=True) as r, open(seed_file_path, "wb") as f:
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, f, length=65536)
 
-        cmd_str = '{} {} {}'.format(parse_relative_path('script/start_tsm.sh'), seed_file_path, loc_str)
-        ret_val = os.system(cmd_str)
-        if ret_val != 0:
-            self._logger.error('script `{}` returns {}'.format(cmd_str, ret_val))
+        # start_tsm.sh has no shebang, run it through sh explicitly
+        self._run_cmd(['sh', self._start_tsm, seed_file_path, loc_str])
 
         if self._delete_after_activation:
-            os.system('rm {}'.format(seed_file_path))
+            try:
+                os.unlink(seed_file_path)
+            except OSError as e:
+                self._logger.warning('fail deleting seed file {}: {}'.format(seed_file_path, e))
 
-    @staticmethod
-    def list_torrent():
-        os.system('transmission-remote -l')
+    def _run_cmd(self, cmd):
+        cmd_str = ' '.join(cmd)
+        try:
+            ret_val = subprocess.run(cmd).returncode
+        except OSError as e:
+            self._logger.error('fail running `{}`: {}'.format(cmd_str, e))
+            print('fail running `{}`: {}'.format(cmd_str, e))
+            return
+        if ret_val != 0:
+            self._logger.error('command `{}` returns {}'.format(cmd_str, ret_val))
 
-    @staticmethod
-    def remove_torrent(op_str):
-        id_re = re.findall(r'trm (\d+)', op_str, re.I)
+    def list_torrent(self):
+        self._run_cmd(['transmission-remote', '-l'])
+
+    def remove_torrent(self, op_str):
+        id_re = _RE_TRM.findall(op_str)
         if len(id_re) == 0:
             print('no such torrent id')
             return
         id_str = id_re[0]
-        os.system('transmission-remote -t {} -r'.format(id_str))
+        self._run_cmd(['transmission-remote', '-t', id_str, '-r'])
 
 
 if __name__ == "__main__":
@@ -389,7 +504,7 @@ if __name__ == "__main__":
         print("FATAL: config file doesn't exist at {}.".format(config_location))
         exit(-1)
     with open(config_location) as f_obj:
-        config_obj = yaml.load(f_obj.read())
+        config_obj = yaml.load(f_obj, Loader=YamlLoader)
     if config_obj is None:
         print("FATAL: fail loading config file {}.".format(config_location))
 